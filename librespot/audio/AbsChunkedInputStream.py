@@ -82,10 +82,10 @@ class AbsChunkedInputStream(InputStream, HaltListener):
 
         return k
 
-    def requested_chunks(self) -> typing.List[bool]:
+    def requested_chunks(self) -> bytearray:
         raise NotImplementedError()
 
-    def available_chunks(self) -> typing.List[bool]:
+    def available_chunks(self) -> bytearray:
         raise NotImplementedError()
 
     def chunks(self) -> int:
@@ -106,15 +106,15 @@ class AbsChunkedInputStream(InputStream, HaltListener):
             raise TypeError()
 
         if not self.requested_chunks()[chunk]:
-            self.request_chunk_from_stream(chunk)
             self.requested_chunks()[chunk] = True
+            self.request_chunk_from_stream(chunk)
 
         for i in range(chunk + 1,
                        min(self.chunks() - 1, chunk + self.preload_ahead) + 1):
-            if (self.requested_chunks()[i]
+            if (not self.requested_chunks()[i]
                     and self.retries[i] < self.preload_chunk_retries):
+                self.requested_chunks()[i] = True
                 self.request_chunk_from_stream(i)
-                self.requested_chunks()[chunk] = True
 
         if wait:
             if self.available_chunks()[chunk]:
@@ -127,12 +127,16 @@ class AbsChunkedInputStream(InputStream, HaltListener):
 
                 self.chunk_exception = None
                 self.wait_for_chunk = chunk
-                self.wait_lock.wait()
+                # The chunk may complete or fail before we start waiting
+                while not (self.closed or self.available_chunks()[chunk]
+                           or not self.requested_chunks()[chunk]):
+                    self.wait_lock.wait()
+                self.wait_for_chunk = -1
 
                 if self.closed:
                     return
 
-                if self.chunk_exception is not None:
+                if not self.available_chunks()[chunk]:
                     if self.should_retry(chunk):
                         retry = True
                     else:
@@ -173,10 +177,12 @@ class AbsChunkedInputStream(InputStream, HaltListener):
             chunk_off = int(self._pos % (128 * 1024))
 
             self.check_availability(chunk, True, False)
+            if self.closed:
+                raise IOError("Stream is closed!")
 
             copy = min(len(self.buffer()[chunk]) - chunk_off, length - i)
-            b[offset + 0:copy] = self.buffer()[chunk][chunk_off:chunk_off +
-                                                      copy]
+            b[offset + i:offset + i + copy] = memoryview(
+                self.buffer()[chunk])[chunk_off:chunk_off + copy]
             i += copy
             self._pos += copy
 
@@ -192,6 +198,8 @@ class AbsChunkedInputStream(InputStream, HaltListener):
 
         chunk = int(self._pos / (128 * 1024))
         self.check_availability(chunk, True, False)
+        if self.closed:
+            raise IOError("Stream is closed!")
 
         b = self.buffer()[chunk][self._pos % (128 * 1024)]
         self._pos = self._pos + 1
@@ -2,8 +2,10 @@ from __future__ import annotations
 
 import concurrent.futures
 import logging
-import math
+import queue
 import random
+import re
+import threading
 import time
 import typing
 import urllib.parse
@@ -20,6 +22,8 @@ from librespot.common import Utils
 from librespot.proto import StorageResolve_pb2 as StorageResolve
 
 if typing.TYPE_CHECKING:
+    import requests
+
     from librespot.audio.decrypt.AudioDecrypt import AudioDecrypt
     from librespot.audio.HaltListener import HaltListener
     from librespot.cache.CacheManager import CacheManager
@@ -110,65 +114,66 @@ class CdnManager:
         pass
 
     class InternalResponse:
-        _buffer: bytearray
+        _buffer: memoryview
         _headers: typing.Dict[str, str]
 
-        def __init__(self, buffer: bytearray, headers: typing.Dict[str, str]):
+        def __init__(self, buffer: memoryview, headers: typing.Dict[str, str]):
             self._buffer = buffer
             self._headers = headers
 
     class CdnUrl:
+        _token: typing.Final[re.Pattern] = re.compile(
+            r"[?&]__token__=([^&#]+)")
+        _token_expiration: typing.Final[re.Pattern] = re.compile(
+            r"(?:^|~)exp=(\d+)")
         __cdnManager = None
         __fileId: bytes
         _expiration: int
+        _refreshLock: threading.Lock
         _url: str
 
         def __init__(self, cdn_manager, file_id: bytes, url: str):
             self.__cdnManager: CdnManager = cdn_manager
             self.__fileId = file_id
+            self._refreshLock = threading.Lock()
             self.set_url(url)
 
         def url(self):
             if self._expiration == -1:
                 return self._url
 
-            if self._expiration <= int(time.time() * 1000) + 5 * 60 * 1000:
-                self._url = self.__cdnManager.get_audio_url(self.__fileId)
+            if self._expires_soon():
+                with self._refreshLock:
+                    # Another prefetch worker may have refreshed it already
+                    if self._expires_soon():
+                        self.set_url(
+                            self.__cdnManager.get_audio_url(self.__fileId))
+
+            return self._url
 
-            return self.url
+        def _expires_soon(self) -> bool:
+            return (self._expiration <=
+                    time.time_ns() // 1000000 + 5 * 60 * 1000)
 
         def set_url(self, url: str):
             self._url = url
 
             if self.__fileId is not None:
-                token_url = urllib.parse.urlparse(url)
-                token_query = urllib.parse.parse_qs(token_url.query)
-                token_list = token_query.get("__token__")
-                try:
-                    token_str = str(token_list[0])
-                except TypeError:
-                    token_str = ""
-                if token_str != "None" and len(token_str) != 0:
-                    expire_at = None
-                    split = token_str.split("~")
-                    for s in split:
-                        try:
-                            i = s.index("=")
-                        except ValueError:
-                            continue
-
-                        if s[:i] == "exp":
-                            expire_at = int(s[i + 1:])
-                            break
-
-                    if expire_at is None:
+                token = self._token.search(url)
+                if token is not None:
+                    token_str = token.group(1)
+                    if "%" in token_str or "+" in token_str:
+                        token_str = urllib.parse.unquote_plus(token_str)
+                    match = self._token_expiration.search(token_str)
+                    if match is None:
                         self._expiration = -1
                         self.__cdnManager._LOGGER.warning(
                             "Invalid __token__ in CDN url: {}".format(url))
                         return
 
-                    self._expiration = expire_at * 1000
+                    self._expiration = int(match.group(1)) * 1000
                 else:
+                    token_url = urllib.parse.urlparse(url)
                     try:
                         i = token_url.query.index("_")
                     except ValueError:
@@ -188,18 +193,25 @@ class CdnManager:
             GeneralWritableStream.GeneralWritableStream,
     ):
         _session: Session
+        _client: requests.Session
         _streamId: StreamId.StreamId
-        _executorService = concurrent.futures.ThreadPoolExecutor()
+        _executorService = concurrent.futures.ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="cdn-prefetch")
+        _decryptService = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="cdn-decrypt")
         _audioFormat: SuperAudioFormat
         _audioDecrypt: AudioDecrypt
         _cdnUrl = None
         _size: int
-        _buffer: typing.List[bytearray]
-        _available: typing.List[bool]
-        _requested: typing.List[bool]
+        _buffer: typing.List[typing.Optional[bytearray]]
+        _available: bytearray
+        _requested: bytearray
         _chunks: int
         _internalStream: CdnManager.Streamer.InternalStream
         _haltListener: HaltListener
+        _pendingChunks: queue.SimpleQueue
+        _maxBatchChunks: int = 4
+        _bufferPool: queue.SimpleQueue
 
         def __init__(
             self,
@@ -212,11 +224,14 @@ class CdnManager:
             halt_listener: HaltListener,
         ):
             self._session = session
+            self._client = session.client()
             self._streamId = stream_id
             self._audioFormat = audio_format
             self._audioDecrypt = audio_decrypt
             self._cdnUrl = cdn_url
             self._haltListener = halt_listener
+            self._pendingChunks = queue.SimpleQueue()
+            self._bufferPool = queue.SimpleQueue()
 
             resp = self.request(range_start=0,
                                 range_end=ChannelManager.CHUNK_SIZE - 1)
@@ -226,19 +241,21 @@ class CdnManager:
 
             split = Utils.split(content_range, "/")
             self._size = int(split[1])
-            self._chunks = int(
-                math.ceil(self._size / ChannelManager.CHUNK_SIZE))
+            self._chunks = -(-self._size // ChannelManager.CHUNK_SIZE)
 
             first_chunk = resp._buffer
 
-            self._available = [False for _ in range(self._chunks)]
-            self._requested = [False for _ in range(self._chunks)]
-            self._buffer = [bytearray() for _ in range(self._chunks)]
+            self._available = bytearray(self._chunks)
+            self._requested = bytearray(self._chunks)
+            self._buffer = [None] * self._chunks
             self._internalStream = CdnManager.Streamer.InternalStream(
                 self, False)
 
-            self._requested[0] = True
-            self.write_chunk(first_chunk, 0, False)
+            if len(first_chunk) == min(ChannelManager.CHUNK_SIZE,
+                                       self._size):
+                self._requested[0] = True
+                self.write_chunk(first_chunk, 0, False)
+            self._release_buffer(first_chunk.obj)
 
         def write_chunk(self, chunk: bytes, chunk_index: int,
                         cached: bool) -> None:
@@ -269,8 +286,116 @@ class CdnManager:
             return self._audioDecrypt.decrypt_time_ms()
 
         def request_chunk(self, index: int) -> None:
-            resp = self.request(index)
-            self.write_chunk(resp._buffer, index, False)
+            self.request_chunks(index, 1)
+
+        def request_chunks(self, index: int, count: int) -> None:
+            published = index
+            try:
+                resp = self._client.get(
+                    self._cdnUrl.url(),
+                    headers={
+                        "Range":
+                        "bytes={}-{}".format(
+                            ChannelManager.CHUNK_SIZE * index,
+                            ChannelManager.CHUNK_SIZE * (index + count) - 1)
+                    },
+                    stream=True,
+                )
+
+                with resp:
+                    if resp.status_code != 206:
+                        raise IOError(resp.status_code)
+
+                    buffer = self._acquire_buffer()
+                    try:
+                        view = memoryview(buffer)
+                        size = 0
+                        for block in resp.iter_content(
+                                ChannelManager.CHUNK_SIZE):
+                            view[size:size + len(block)] = block
+                            size += len(block)
+
+                            # Hand each chunk to the decryptor as soon as
+                            # its bytes are in, so the chunk being waited
+                            # on is not held back by the rest of the batch
+                            ready = published
+                            while (ready < index + count
+                                   and size >= self._chunk_end(index, ready)):
+                                ready += 1
+                            if ready > published:
+                                self._decryptService.submit(
+                                    self._write_chunks, view, index,
+                                    published, ready)
+                                published = ready
+                    finally:
+                        # Runs after the writes above on the single
+                        # decrypt worker
+                        self._decryptService.submit(self._release_buffer,
+                                                    buffer)
+            except (IOError, CdnManager.CdnException) as ex:
+                self._notify_chunks_error(published, index + count, ex)
+                return
+
+            if published == index + count:
+                return
+            if published > index:
+                # The CDN may answer with only part of the range
+                for chunk_index in range(published, index + count):
+                    self._pendingChunks.put(chunk_index)
+                self._executorService.submit(self.request_pending_chunks)
+            else:
+                self._notify_chunks_error(
+                    published, index + count,
+                    IOError("Incomplete chunk, received {} bytes".format(
+                        size)))
+
+        def _chunk_end(self, index: int, chunk_index: int) -> int:
+            return (min(ChannelManager.CHUNK_SIZE *
+                        (chunk_index + 1), self._size) -
+                    ChannelManager.CHUNK_SIZE * index)
+
+        def _write_chunks(self, buffer: memoryview, index: int, start: int,
+                          end: int) -> None:
+            for chunk_index in range(start, end):
+                if self._available[chunk_index]:
+                    continue
+                offset = ChannelManager.CHUNK_SIZE * (chunk_index - index)
+                try:
+                    self.write_chunk(
+                        buffer[offset:self._chunk_end(index, chunk_index)],
+                        chunk_index, False)
+                except Exception as ex:
+                    self._internalStream.notify_chunk_error(chunk_index, ex)
+
+        def _notify_chunks_error(self, start: int, end: int, ex) -> None:
+            for chunk_index in range(start, end):
+                if not self._available[chunk_index]:
+                    self._internalStream.notify_chunk_error(chunk_index, ex)
+
+        def request_pending_chunks(self) -> None:
+            indexes = set()
+            while True:
+                try:
+                    index = self._pendingChunks.get_nowait()
+                except queue.Empty:
+                    break
+                if not self._available[index]:
+                    indexes.add(index)
+
+            batches = []
+            for index in sorted(indexes):
+                if (len(batches) > 0
+                        and batches[-1][0] + batches[-1][1] == index
+                        and batches[-1][1] < self._maxBatchChunks):
+                    batches[-1][1] += 1
+                else:
+                    batches.append([index, 1])
+
+            for index, count in batches[1:]:
+                self._executorService.submit(self.request_chunks, index,
+                                             count)
+            if len(batches) > 0:
+                self.request_chunks(*batches[0])
 
         def request(self,
                     chunk: int = None,
@@ -283,21 +408,44 @@ class CdnManager:
                 range_start = ChannelManager.CHUNK_SIZE * chunk
                 range_end = (chunk + 1) * ChannelManager.CHUNK_SIZE - 1
 
-            resp = self._session.client().get(
-                self._cdnUrl._url,
+            resp = self._client.get(
+                self._cdnUrl.url(),
                 headers={
                     "Range": "bytes={}-{}".format(range_start, range_end)
                 },
+                stream=True,
             )
 
-            if resp.status_code != 206:
-                raise IOError(resp.status_code)
+            with resp:
+                if resp.status_code != 206:
+                    raise IOError(resp.status_code)
 
-            body = resp.content
-            if body is None:
+                buffer = self._acquire_buffer()
+                view = memoryview(buffer)
+                size = 0
+                try:
+                    for block in resp.iter_content(ChannelManager.CHUNK_SIZE):
+                        view[size:size + len(block)] = block
+                        size += len(block)
+                except Exception:
+                    self._release_buffer(buffer)
+                    raise
+
+            if size == 0:
+                self._release_buffer(buffer)
                 raise IOError("Response body is empty!")
 
-            return CdnManager.InternalResponse(bytearray(body), resp.headers)
+            return CdnManager.InternalResponse(view[:size], resp.headers)
+
+        def _acquire_buffer(self) -> bytearray:
+            try:
+                return self._bufferPool.get_nowait()
+            except queue.Empty:
+                return bytearray(ChannelManager.CHUNK_SIZE *
+                                 self._maxBatchChunks)
+
+        def _release_buffer(self, buffer: bytearray) -> None:
+            self._bufferPool.put(buffer)
 
         class InternalStream(AbsChunkedInputStream):
             streamer = None
@@ -306,33 +454,34 @@ class CdnManager:
                 self.streamer: CdnManager.Streamer = streamer
                 super().__init__(retry_on_chunk_error)
 
-            def buffer(self) -> typing.List[bytearray]:
+            def buffer(self) -> typing.List[typing.Optional[bytearray]]:
                 return self.streamer._buffer
 
             def size(self) -> int:
                 return self.streamer._size
 
-            def requested_chunks(self) -> typing.List[bool]:
+            def requested_chunks(self) -> bytearray:
                 return self.streamer._requested
 
-            def available_chunks(self) -> typing.List[bool]:
+            def available_chunks(self) -> bytearray:
                 return self.streamer._available
 
             def chunks(self) -> int:
                 return self.streamer._chunks
 
             def request_chunk_from_stream(self, index: int) -> None:
+                self.streamer._pendingChunks.put(index)
                 self.streamer._executorService.submit(
-                    lambda: self.streamer.request_chunk(index))
+                    self.streamer.request_pending_chunks)
 
             def stream_read_halted(self, chunk: int, _time: int) -> None:
                 if self.streamer._haltListener is not None:
                     self.streamer._executorService.submit(
-                        lambda: self.streamer._haltListener.stream_read_halted(
-                            chunk, _time))
+                        self.streamer._haltListener.stream_read_halted, chunk,
+                        _time)
 
             def stream_read_resumed(self, chunk: int, _time: int) -> None:
                 if self.streamer._haltListener is not None:
                     self.streamer._executorService.submit(
-                        lambda: self.streamer._haltListener.
-                        stream_read_resumed(chunk, _time))
+                        self.streamer._haltListener.stream_read_resumed,
+                        chunk, _time)
@@ -1,67 +1,65 @@
+import threading
 import time
 
 from Cryptodome.Cipher import AES
-from Cryptodome.Util import Counter
 
 from librespot.audio.decrypt.AudioDecrypt import AudioDecrypt
 from librespot.audio.storage import ChannelManager
 
 
 class AesAudioDecrypt(AudioDecrypt):
-    audio_aes_iv = bytes([
-        0x72,
-        0xE0,
-        0x67,
-        0xFB,
-        0xDD,
-        0xCB,
-        0xCF,
-        0x77,
-        0xEB,
-        0xE8,
-        0xBC,
-        0x64,
-        0x3F,
-        0x63,
-        0x0D,
-        0x93,
-    ])
+    audio_aes_iv = (b"\x72\xe0\x67\xfb\xdd\xcb\xcf\x77"
+                    b"\xeb\xe8\xbc\x64\x3f\x63\x0d\x93")
     iv_int = int.from_bytes(audio_aes_iv, "big")
-    iv_diff = 0x100
+    blocks_per_chunk = ChannelManager.CHUNK_SIZE // 16
     cipher = None
-    decrypt_count = 0
-    decrypt_total_time = 0
+    cipher_chunk_index = -1
+    cipher_lock: threading.Lock
+    decrypt_time_ns = 0
     key: bytes
 
     def __init__(self, key: bytes):
         self.key = key
+        self.cipher_lock = threading.Lock()
 
     def decrypt_chunk(self, chunk_index: int, buffer: bytes):
-        new_buffer = b""
-        iv = self.iv_int + int(ChannelManager.CHUNK_SIZE * chunk_index / 16)
-        start = time.time_ns()
-        for i in range(0, len(buffer), 4096):
+        start = time.perf_counter_ns()
+        cipher = self._take_cipher(chunk_index)
+        if cipher is None:
+            iv = self.iv_int + chunk_index * self.blocks_per_chunk
             cipher = AES.new(
                 key=self.key,
                 mode=AES.MODE_CTR,
-                counter=Counter.new(128, initial_value=iv),
+                nonce=b"",
+                initial_value=iv,
             )
 
-            count = min(4096, len(buffer) - i)
-            decrypted_buffer = cipher.decrypt(buffer[i:i + count])
-            new_buffer += decrypted_buffer
-            if count != len(decrypted_buffer):
-                raise RuntimeError(
-                    "Couldn't process all data, actual: {}, expected: {}".
-                    format(len(decrypted_buffer), count))
+        new_buffer = bytearray(len(buffer))
+        cipher.decrypt(buffer, output=new_buffer)
 
-            iv += self.iv_diff
+        if len(buffer) == ChannelManager.CHUNK_SIZE:
+            # The counter now sits at the first block of the next chunk
+            with self.cipher_lock:
+                self.cipher = cipher
+                self.cipher_chunk_index = chunk_index + 1
 
-        self.decrypt_total_time += time.time_ns() - start
-        self.decrypt_count += 1
+        elapsed = time.perf_counter_ns() - start
+        if self.decrypt_time_ns == 0:
+            self.decrypt_time_ns = elapsed
+        else:
+            # Moving average weighting the latest chunk by 1/8
+            self.decrypt_time_ns = (self.decrypt_time_ns * 7 + elapsed) >> 3
 
         return new_buffer
 
+    def _take_cipher(self, chunk_index: int):
+        with self.cipher_lock:
+            if self.cipher_chunk_index != chunk_index:
+                return None
+            cipher = self.cipher
+            self.cipher = None
+            self.cipher_chunk_index = -1
+            return cipher
+
     def decrypt_time_ms(self):
-        return (0 if self.decrypt_count == 0 else int(
-            (self.decrypt_total_time / self.decrypt_count) / 1000000))
+        return self.decrypt_time_ns // 1000000